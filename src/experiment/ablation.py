@@ -1,12 +1,11 @@
 import json
 import random
-from copy import deepcopy
 
 from apis import API_TYPES, CodeExecutor
 from llms import Role
 from pptgen import PPTCrew
 from presentation import GroupShape, ShapeElement, SlidePage, TextFrame
-from utils import get_slide_content, pexists, pjoin, tenacity
+from utils import fast_clone, get_slide_content, pexists, pjoin, tenacity
 
 
 class PPTCrew_wo_Structure(PPTCrew):
@@ -56,7 +55,7 @@ class PPTCrew_wo_LayoutInduction(PPTCrew):
         )
         try:
             return self.synergize(
-                deepcopy(self.slide_induction[random.choice(self.layout_names)]),
+                fast_clone(self.slide_induction[random.choice(self.layout_names)]),
                 slide_content,
                 code_executor,
                 images_info,
@@ -87,9 +86,7 @@ class PPTCrew_wo_Decoupling(PPTCrew):
             images_info=image_info,
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide = self._clone_slide(template["template_id"])
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 return edited_slide
@@ -98,7 +95,8 @@ class PPTCrew_wo_Decoupling(PPTCrew):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["agent"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        with self.build_lock:
+            self.empty_prs.build_slide(edited_slide)
         return edited_slide
 
 
@@ -137,9 +135,7 @@ class PPTCrew_wo_SchemaInduction(PPTCrew):
             command_list="\n".join([str(i) for i in command_list]),
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide = self._clone_slide(template["template_id"])
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 break
@@ -148,7 +144,8 @@ class PPTCrew_wo_SchemaInduction(PPTCrew):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["coder"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        with self.build_lock:
+            self.empty_prs.build_slide(edited_slide)
         return edited_slide
 
 
@@ -1,21 +1,31 @@
+from __future__ import annotations
+
+import asyncio
 import json
 import os
+import shutil
 from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 
 import func_argparse
 import jsonlines
+import numpy as np
+import torch
 from jinja2 import Template
 from PIL import Image
 from pptx import Presentation
-from torch import cosine_similarity
-from tqdm import tqdm
-from transformers import CLIPModel, CLIPProcessor
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
+from torch.nn.functional import normalize
+from tqdm.asyncio import tqdm
 
 import llms
 from presentation import Presentation
-from utils import edit_distance, ppt_to_images
+from utils import get_image_size, get_json_from_response, pjoin, ppt_to_images
+
+if TYPE_CHECKING:
+    from transformers import CLIPModel, CLIPProcessor
 
 outline_template = Template(
     """
@@ -42,7 +52,7 @@ mapping_template = Template(
 )
 generation_template = Template(
     """
-    You are a presentation generator from a source of text. You have to generate the slide number {{slide_index}}. Previous slide headings and slide contents are given below in the format of a list of dictionaries. {{previous_slide}} Given the following slide heading and the source of text respectively, create the content of the slide number {{slide_index}} such that: 1. The slide should have maximum {{max_bullet}} bullet points. 2. Ensure that the content of the bullet points are coming strictly from the given source of text only. 3. The content of the slide is very relevant to the given slide heading 4. Each bullet point should have a maximum of 10 words 5. Ensure that this slide does not have any content repeated from the previous slides. 6. The flow of the overall presentation is nice. 7. Do not prefix the slide title before the bullet poide nts in the output  SliTitle: {{slide_heading}} Source of text: {{text}}
+    You are a presentation generator from a source of text. You have to generate the slide number {{slide_index}}. Previous slide headings are given below in the format of a list of strings. {{previous_slide}} Given the following slide heading and the source of text respectively, create the content of the slide number {{slide_index}} such that: 1. The slide should have maximum {{max_bullet}} bullet points. 2. Ensure that the content of the bullet points are coming strictly from the given source of text only. 3. The content of the slide is very relevant to the given slide heading 4. Each bullet point should have a maximum of 10 words 5. Ensure that this slide does not repeat the topics of the previous slide headings. 6. The flow of the overall presentation is nice. 7. Do not prefix the slide title before the bullet poide nts in the output  SliTitle: {{slide_heading}} Source of text: {{text}}
     Example Output:
     ["bullet point 1", "bullet point 2"]
     Output: give your output as a list of strings in json format
@@ -50,65 +60,111 @@ generation_template = Template(
 )
 
 
-def filter_aspect_ratio(image: list[str]):
-    filtered_images = []
-    for i in image:
-        size = image = Image.open(i).size
-        long, short = max(size), min(size)
-        if long / short < 4:
-            filtered_images.append(i)
-    return filtered_images
+def filter_aspect_ratio(images: list[str]):
+    with ThreadPoolExecutor(16) as executor:
+        sizes = list(executor.map(get_image_size, images))
+    return [image for image, size in zip(images, sizes) if max(size) / min(size) < 4]
 
 
-def get_indexed_sections(bird_eye: dict, indexs: list[str]):
-    indexed_sections = []
-    for section in bird_eye["sections"]:
-        for subsection in section["subsections"]:
-            if any(edit_distance(key, next(iter(subsection))) > 0.9 for key in indexs):
-                indexed_sections.append(subsection)
-    return indexed_sections
+def get_subsections(bird_eye: dict):
+    subsections = [
+        subsection
+        for section in bird_eye["sections"]
+        for subsection in section["subsections"]
+    ]
+    return subsections, [next(iter(subsection)) for subsection in subsections]
 
 
-def generate_content(source_text: str, bird_eye: dict, max_bullet: int):
-    bird_eye_headdings = []
-    for section in bird_eye["sections"]:
-        bird_eye_headdings.extend(
-            [next(iter(subsec)) for subsec in section["subsections"]]
-        )
-    outline: list[str] = llms.language_model(
+def get_indexed_sections(
+    subsections: list[dict], subsection_keys: list[str], indexs: list[str]
+):
+    if len(indexs) == 0 or len(subsections) == 0:
+        return []
+    # 1 - levenshtein / max(len) of all pairs in one call, the cutoff prunes early
+    similarity = cdist(
+        indexs,
+        subsection_keys,
+        scorer=Levenshtein.normalized_similarity,
+        score_cutoff=0.9,
+    )
+    matched = np.nonzero((similarity > 0.9).any(axis=0))[0]
+    return [subsections[idx] for idx in matched]
+
+
+def get_mapping_prompt(outline: list[str], bird_eye: dict):
+    return mapping_template.render(
+        outline_headings=outline,
+        document_heading_from_bird_eye_view=get_subsections(bird_eye)[1],
+        bird_eye_view=bird_eye,
+    )
+
+
+def get_generation_prompt(
+    slide_idx: int,
+    outline: list[str],
+    mapping: dict,
+    subsections: list[dict],
+    subsection_keys: list[str],
+    max_bullet: int,
+):
+    slide_title = outline[slide_idx]
+    return generation_template.render(
+        slide_index=slide_idx + 1,
+        slide_heading=slide_title,
+        text=get_indexed_sections(
+            subsections, subsection_keys, mapping.get(slide_title, [])
+        ),
+        previous_slide=outline[:slide_idx],
+        max_bullet=max_bullet,
+    )
+
+
+def get_slides(outline: list[str], mapping: dict, slides_bullets: list[list[str]]):
+    return [
+        {
+            "title": slide_title,
+            "bullets": bullet_points,
+            "indexed_sections": mapping.get(slide_title, []),
+        }
+        for slide_title, bullet_points in zip(outline, slides_bullets)
+    ]
+
+
+async def generate_content(
+    source_text: str, bird_eye: dict, max_bullet: int, concurrency: int = 8
+):
+    outline: list[str] = await llms.language_model.call_async(
         outline_template.render(text=source_text), return_json=True
     )
     assert len(outline) != 0, "No outline found"
-    mapping = llms.language_model(
-        mapping_template.render(
-            outline_headings=outline,
-            document_heading_from_bird_eye_view=bird_eye_headdings,
-            bird_eye_view=bird_eye,
-        ),
-        return_json=True,
+    mapping = await llms.language_model.call_async(
+        get_mapping_prompt(outline, bird_eye), return_json=True
     )
-    slides = []
-    for slide_title in outline:
-        bullet_points = llms.language_model(
-            generation_template.render(
-                slide_heading=slide_title,
-                text=get_indexed_sections(bird_eye, mapping.get(slide_title, [])),
-                previous_slide=slides,
-                max_bullet=max_bullet,
-            ),
-            return_json=True,
-        )
-        slides.append(
-            {
-                "title": slide_title,
-                "bullets": bullet_points,
-                "indexed_sections": mapping.get(slide_title, []),
-            }
-        )
-    return slides
+    subsections, subsection_keys = get_subsections(bird_eye)
+    # each slide only sees the headings before it, so slides are generated concurrently
+    semaphore = asyncio.Semaphore(concurrency)
 
+    async def generate_bullets(slide_idx: int):
+        async with semaphore:
+            return await llms.language_model.call_async(
+                get_generation_prompt(
+                    slide_idx,
+                    outline,
+                    mapping,
+                    subsections,
+                    subsection_keys,
+                    max_bullet,
+                ),
+                return_json=True,
+            )
 
-def generate_slides(
+    slides_bullets = await asyncio.gather(
+        *[generate_bullets(slide_idx) for slide_idx in range(len(outline))]
+    )
+    return get_slides(outline, mapping, slides_bullets)
+
+
+async def generate_slides(
     output_dir: str,
     source_text: str,
     bird_eye: dict,
@@ -117,33 +173,87 @@ def generate_slides(
     processor: CLIPProcessor,
 ):
     os.makedirs(output_dir, exist_ok=True)
-    images = filter_aspect_ratio(images)
-    slides = generate_content(source_text, bird_eye, 7)
-    image_embeddings = model.get_image_features(
-        **processor(images=[Image.open(i) for i in images], return_tensors="pt").to(
-            "cuda"
+    images, slides = await asyncio.gather(
+        asyncio.to_thread(filter_aspect_ratio, images),
+        generate_content(source_text, bird_eye, 7),
+    )
+    # CLIP inference and rendering are blocking, keep them off the event loop
+    await asyncio.to_thread(build_slides, output_dir, slides, images, model, processor)
+
+
+def get_clip_model():
+    from transformers import CLIPModel, CLIPProcessor
+
+    model = CLIPModel.from_pretrained(
+        "openai/clip-vit-large-patch14", torch_dtype=torch.float16
+    )
+    processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
+    return model.to("cuda").eval(), processor
+
+
+def load_image(image: str):
+    with Image.open(image) as img:
+        return img.convert("RGB")
+
+
+def encode_images(
+    images: list[str],
+    model: CLIPModel,
+    processor: CLIPProcessor,
+    batchsize: int = 64,
+):
+    with ThreadPoolExecutor(16) as executor:
+        pil_images = list(executor.map(load_image, images))
+    image_embeddings = []
+    with torch.inference_mode():
+        for i in range(0, len(pil_images), batchsize):
+            pixel_values = processor(
+                images=pil_images[i : i + batchsize], return_tensors="pt"
+            )["pixel_values"].to(model.dtype)
+            image_embeddings.append(
+                model.get_image_features(
+                    pixel_values=pixel_values.pin_memory().to("cuda", non_blocking=True)
+                )
+            )
+    return torch.cat(image_embeddings)
+
+
+def build_slides(
+    output_dir: str,
+    slides: list[dict],
+    images: list[str],
+    model: CLIPModel,
+    processor: CLIPProcessor,
+):
+    image_embeddings = encode_images(images, model, processor)
+    with torch.inference_mode():
+        text_embeddings = model.get_text_features(
+            **processor(
+                text=["\n".join(slide["bullets"]) for slide in slides],
+                return_tensors="pt",
+                padding=True,
+                max_length=77,
+                truncation=True,
+            ).to("cuda")
         )
-    ).unsqueeze(0)
-    text_embeddings = model.get_text_features(
-        **processor(
-            text=["\n".join(slide["bullets"]) for slide in slides],
-            return_tensors="pt",
-            padding=True,
-            max_length=77,
-            truncation=True,
-        ).to("cuda")
-    ).unsqueeze(1)
-    similarity = cosine_similarity(image_embeddings, text_embeddings, dim=-1)
+    # cosine similarity of all (slide, image) pairs as a single matmul
+    similarity = (
+        normalize(text_embeddings.float(), dim=-1)
+        @ normalize(image_embeddings.float(), dim=-1).T
+    )
+    # copy back once, instead of synchronizing with the GPU for every slide
+    similarity = similarity.cpu().numpy()
+    max_similarity = similarity.max(axis=1)
+    best_images = similarity.argmax(axis=1)
     pptx = Presentation()
     for slide_idx, slide in enumerate(slides):  # match image here
         title = slide["title"]
         bullets = slide["bullets"]
 
-        subsimilarity = similarity[slide_idx]
-        if subsimilarity.max() > 0.8:
+        if max_similarity[slide_idx] > 0.8:
             slide = pptx.slides.add_slide(pptx.slide_layouts[6])
             bullets_placeholder = slide.shapes.placeholders[2]
-            image = images[subsimilarity.argmax()]
+            image = images[best_images[slide_idx]]
             slides[slide_idx]["image"] = image
             slide.shapes.placeholders[1].insert_picture(image)
         else:
@@ -161,47 +271,159 @@ def generate_slides(
     ppt_to_images(output_dir + "/final.pptx", output_dir + "/slide_images")
 
 
-def generate(model: Literal["Qwen2.5", "gpt"]):
+def load_folder(pdf_folder: str):
+    with open(f"{pdf_folder}/source.md") as f:
+        source_text = f.read()
+    with open(f"{pdf_folder}/refined_doc.json") as f:
+        bird_eye = json.load(f)
+    with open(f"{pdf_folder}/image_caption.json") as f:
+        images = list(json.load(f))
+    return source_text, bird_eye, images
+
+
+def generate(
+    model: Literal["Qwen2.5", "gpt"], concurrency: int = 8, use_cache: bool = True
+):
     if model == "Qwen2.5":
         llms.language_model = llms.qwen2_5
     elif model == "gpt":
         llms.language_model = llms.gpt4o
+    # rerunning on unchanged documents reuses the outline and mapping responses
+    llms.language_model.set_cache(use_cache)
 
     print("Generating slides on baseline with ", llms.language_model.model)
     llm_name = llms.get_simple_modelname(llms.language_model)
-    model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14").to("cuda").eval()
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
+    model, processor = get_clip_model()
     folders = list(glob("data/*/pdf/*"))
-    progress = tqdm(total=len(folders))
 
-    def process_folder(pdf_folder, model, processor):
-        source_text = open(f"{pdf_folder}/source.md").read()
-        bird_eye = json.load(open(f"{pdf_folder}/refined_doc.json"))
-        images = json.load(open(f"{pdf_folder}/image_caption.json")).keys()
+    async def process_folder(pdf_folder, semaphore):
         output_dir = f"{pdf_folder}/docpres/{llm_name}"
         if os.path.exists(output_dir + "/final.jsonl"):
-            progress.write(f"Skipping {pdf_folder}")
-            progress.update(1)
+            tqdm.write(f"Skipping {pdf_folder}")
             return
+        async with semaphore:
+            try:
+                source_text, bird_eye, images = await asyncio.to_thread(
+                    load_folder, pdf_folder
+                )
+                await generate_slides(
+                    output_dir,
+                    source_text,
+                    bird_eye,
+                    images,
+                    model,
+                    processor,
+                )
+            except Exception as e:
+                print(f"Error in {pdf_folder}: {e}")
+
+    async def process_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        await tqdm.gather(*[process_folder(f, semaphore) for f in folders])
+
+    asyncio.run(process_all())
+
+
+def parse_responses(responses: list[str]):
+    parsed = []
+    for response in responses:
+        try:
+            parsed.append(get_json_from_response(response))
+        except Exception:
+            parsed.append(None)
+    return parsed
+
+
+def generate_batch(max_bullet: int = 7):
+    """
+    Generate slides on baseline with OpenAI's Batch API,
+    submitting each generation stage of all PDFs as a single batch.
+    """
+    llms.language_model = llms.gpt4o
+    print("Generating slides on baseline in batch with ", llms.language_model.model)
+    llm_name = llms.get_simple_modelname(llms.language_model)
+    batch_dir = f"data/batch/docpres/{llm_name}"
+    os.makedirs(batch_dir, exist_ok=True)
+    folders = [
+        pdf_folder
+        for pdf_folder in glob("data/*/pdf/*")
+        if not os.path.exists(f"{pdf_folder}/docpres/{llm_name}/final.jsonl")
+    ]
+    with ThreadPoolExecutor(8) as executor:
+        contents = list(executor.map(load_folder, folders))
+    tasks = [
+        {
+            "folder": pdf_folder,
+            "output_dir": f"{pdf_folder}/docpres/{llm_name}",
+            "source_text": source_text,
+            "bird_eye": bird_eye,
+            "images": images,
+        }
+        for pdf_folder, (source_text, bird_eye, images) in zip(folders, contents)
+    ]
+    if len(tasks) == 0:
+        print("No pending PDFs to generate")
+        return
+
+    outlines = parse_responses(
+        llms.language_model.submit_batch(
+            [outline_template.render(text=task["source_text"]) for task in tasks],
+            pjoin(batch_dir, "outline.jsonl"),
+        )
+    )
+    tasks = [task | {"outline": o} for task, o in zip(tasks, outlines) if o]
+    mappings = parse_responses(
+        llms.language_model.submit_batch(
+            [get_mapping_prompt(task["outline"], task["bird_eye"]) for task in tasks],
+            pjoin(batch_dir, "mapping.jsonl"),
+        )
+    )
+    tasks = [
+        task | {"mapping": m, "subsections": get_subsections(task["bird_eye"])}
+        for task, m in zip(tasks, mappings)
+        if m
+    ]
+    slide_indexs = [
+        (task_idx, slide_idx)
+        for task_idx, task in enumerate(tasks)
+        for slide_idx in range(len(task["outline"]))
+    ]
+    bullets = parse_responses(
+        llms.language_model.submit_batch(
+            [
+                get_generation_prompt(
+                    slide_idx,
+                    tasks[task_idx]["outline"],
+                    tasks[task_idx]["mapping"],
+                    *tasks[task_idx]["subsections"],
+                    max_bullet,
+                )
+                for task_idx, slide_idx in slide_indexs
+            ],
+            pjoin(batch_dir, "generation.jsonl"),
+        )
+    )
+    for (task_idx, _), bullet_points in zip(slide_indexs, bullets):
+        tasks[task_idx].setdefault("bullets", []).append(bullet_points)
+
+    model, processor = get_clip_model()
+    for task in tqdm(tasks):
+        if any(bullet_points is None for bullet_points in task["bullets"]):
+            print(f"Error in {task['folder']}: failed to generate slide contents")
+            continue
         try:
-            generate_slides(
-                output_dir,
-                source_text,
-                bird_eye,
-                list(images),
+            os.makedirs(task["output_dir"], exist_ok=True)
+            build_slides(
+                task["output_dir"],
+                get_slides(task["outline"], task["mapping"], task["bullets"]),
+                filter_aspect_ratio(task["images"]),
                 model,
                 processor,
             )
-            progress.update(1)
         except Exception as e:
-            print(f"Error in {pdf_folder}: {e}")
-
-    # for folder in folders:
-    #     process_folder(folder, model, processor)
-
-    with ThreadPoolExecutor() as executor:
-        list(executor.map(lambda f: process_folder(f, model, processor), folders))
+            print(f"Error in {task['folder']}: {e}")
+    shutil.rmtree(batch_dir)
 
 
 if __name__ == "__main__":
-    func_argparse.main([generate])
+    func_argparse.main([generate, generate_batch])
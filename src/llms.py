@@ -1,25 +1,38 @@
+from __future__ import annotations
+
 import asyncio
 import base64
+import hashlib
+import io
+import json
 import os
+import pickle
 import re
+import sqlite3
+import threading
+from copy import copy
 from dataclasses import asdict, dataclass
+from functools import lru_cache
 from math import ceil
+from time import sleep
+from typing import TYPE_CHECKING
 
 import jsonlines
-import requests
 import tiktoken
 import yaml
-from FlagEmbedding import BGEM3FlagModel
 from jinja2 import Environment, Template
 from oaib import Auto
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from PIL import Image
-from torch import Tensor, cosine_similarity
+from torch import Tensor, cat, cosine_similarity, stack
 
 from model_utils import get_text_embedding
-from utils import get_json_from_response, pexists, pjoin, print, tenacity
+from utils import CACHE_DIR, get_json_from_response, pexists, pjoin, print, tenacity
+
+if TYPE_CHECKING:
+    from FlagEmbedding import BGEM3FlagModel
 
-ENCODING = tiktoken.encoding_for_model("gpt-4o")
+ENCODING = tiktoken.get_encoding("o200k_base")  # the encoding of gpt-4o
 
 
 def run_async(coroutine):
@@ -41,27 +54,185 @@ def run_async(coroutine):
     return job
 
 
+def fit_image_size(width: int, height: int, max_size: int = 1024):
+    """
+    Scale an image size to fit within max_size, the size an image is billed at.
+    """
+    if width > max_size or height > max_size:
+        if width > height:
+            height = int(height * max_size / width)
+            width = max_size
+        else:
+            width = int(width * max_size / height)
+            height = max_size
+    return width, height
+
+
+@lru_cache(maxsize=32)
+def encode_image(image: str, mtime_ns: int, file_size: int) -> str:
+    """
+    Encode an image to base64, downscaled to the size it is billed at.
+    The modification time and file size are part of the cache key, so a changed image is encoded again.
+    Only a few encodings are kept, each holds a whole image.
+    """
+    with Image.open(image) as img:
+        size = fit_image_size(*img.size)
+        if size != img.size:
+            buffer = io.BytesIO()
+            img.convert("RGB").resize(size, Image.LANCZOS).save(
+                buffer, format="JPEG", quality=85
+            )
+            return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    with open(image, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+@lru_cache(maxsize=128)
+def calc_text_tokens(text: str) -> int:
+    """
+    Calculate the number of tokens for a text, cached for repeated texts like system prompts.
+    """
+    return len(ENCODING.encode(text))
+
+
 def calc_image_tokens(images: list[str]):
     """
     Calculate the number of tokens for a list of images.
     """
     tokens = 0
     for image in images:
-        with open(image, "rb") as f:
-            width, height = Image.open(f).size
-        if width > 1024 or height > 1024:
-            if width > height:
-                height = int(height * 1024 / width)
-                width = 1024
-            else:
-                width = int(width * 1024 / height)
-                height = 1024
+        with Image.open(image) as img:
+            width, height = fit_image_size(*img.size)
         h = ceil(height / 512)
         w = ceil(width / 512)
         tokens += 85 + 170 * h * w
     return tokens
 
 
+class ResponseCache:
+    """
+    A persistent cache of model responses, keyed by the hash of the model and messages.
+    Responses are kept in memory and in a sqlite database shared across runs.
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Initialize the ResponseCache.
+
+        Args:
+            db_path (str): The path to the sqlite database.
+        """
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.memory: dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)"
+        )
+
+    @staticmethod
+    def get_key(model: str, messages: list) -> str:
+        return hashlib.sha256(json.dumps([model, messages]).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        if key in self.memory:
+            return self.memory[key]
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        self.memory[key] = row[0]
+        return row[0]
+
+    def set(self, key: str, response: str):
+        self.memory[key] = response
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, response)
+            )
+            self.conn.commit()
+
+
+class SemanticCache:
+    """
+    An in-memory cache of responses, reused for identical or near-identical prompts.
+    Prompts are matched by hash first, then by the cosine similarity of their embeddings
+    if the caller allows near-identical prompts to share a response.
+    """
+
+    def __init__(self, text_model: BGEM3FlagModel, threshold: float = 0.98):
+        """
+        Initialize the SemanticCache.
+
+        Args:
+            text_model (BGEM3FlagModel): The text model to embed prompts.
+            threshold (float): The minimum similarity to reuse a cached response.
+        """
+        self.text_model = text_model
+        self.threshold = threshold
+        self.exact: dict[str, str] = {}
+        self.keys: Tensor = None
+        self.values: list[str] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(name: str, system_message: str, prompt: str) -> str:
+        return hashlib.sha1(
+            json.dumps([name, system_message, prompt]).encode()
+        ).hexdigest()
+
+    def get(self, key: str, prompt: str, similar: bool = False) -> str | None:
+        with self.lock:
+            response = self.exact.get(key)
+            keys, values = self.keys, self.values
+        if response is not None or not similar or keys is None:
+            return response
+        embedding = get_text_embedding(prompt, self.text_model)
+        score, idx = cosine_similarity(
+            keys, embedding.to(keys.device).unsqueeze(0), dim=-1
+        ).max(dim=0)
+        if score.item() > self.threshold:
+            return values[idx.item()]
+        return None
+
+    def set(self, key: str, prompt: str, response: str, similar: bool = False):
+        with self.lock:
+            self.exact[key] = response
+        if not similar:
+            return
+        embedding = get_text_embedding(prompt, self.text_model).unsqueeze(0)
+        with self.lock:
+            if self.keys is None:
+                self.keys = embedding
+            else:
+                self.keys = cat([self.keys, embedding.to(self.keys.device)])
+            self.values = self.values + [response]
+
+    def save(self, cache_file: str):
+        with self.lock:
+            data = {
+                "exact": self.exact,
+                "keys": None if self.keys is None else self.keys.cpu(),
+                "values": self.values,
+            }
+        with open(cache_file, "wb") as f:
+            pickle.dump(data, f)
+
+    def load(self, cache_file: str):
+        with open(cache_file, "rb") as f:
+            data = pickle.load(f)
+        keys = data["keys"]
+        # keys are saved on the cpu, move them once to the device of new embeddings
+        if keys is not None:
+            keys = keys.to(self.text_model.device)
+        with self.lock:
+            self.exact = data["exact"]
+            self.keys = keys
+            self.values = data["values"]
+
+
 class LLM:
     """
     A wrapper class to interact with a language model.
@@ -72,6 +243,7 @@ class LLM:
         model: str = "gpt-4o-2024-08-06",
         api_base: str = None,
         use_batch: bool = False,
+        use_cache: bool = False,
     ) -> None:
         """
         Initialize the LLM.
@@ -80,8 +252,10 @@ class LLM:
             model (str): The model name.
             api_base (str): The base URL for the API.
             use_batch (bool): Whether to use OpenAI's Batch API, which is single thread only.
+            use_cache (bool): Whether to reuse responses of identical requests across runs.
         """
         self.client = OpenAI(base_url=api_base)
+        self.async_client = AsyncOpenAI(base_url=api_base)
         if use_batch:
             self.oai_batch = Auto(loglevel=0)
         assert (
@@ -90,6 +264,7 @@ class LLM:
         self.model = model
         self.api_base = api_base
         self._use_batch = use_batch
+        self.set_cache(use_cache)
 
     @tenacity
     def __call__(
@@ -117,15 +292,11 @@ class LLM:
         Returns:
             str | dict | list: The response from the model.
         """
-        if content.startswith("You are"):
-            system_message, content = content.split("\n", 1)
-        if history is None:
-            history = []
-        if isinstance(images, str):
-            images = [images]
-        system, message = self.format_message(content, images, system_message)
-        if self._use_batch:
-            result = run_async(self._run_batch(system + history + message, delay_batch))
+        messages, message, cache_key, response = self._prepare_call(
+            content, images, system_message, history
+        )
+        if response is None and self._use_batch:
+            result = run_async(self._run_batch(messages, delay_batch))
             if delay_batch:
                 return
             try:
@@ -135,19 +306,120 @@ class LLM:
             except Exception as e:
                 print("Failed to get response from batch")
                 raise e
-        else:
+        elif response is None:
             completion = self.client.chat.completions.create(
-                model=self.model, messages=system + history + message
+                model=self.model, messages=messages
+            )
+            response = completion.choices[0].message.content
+        return self._finish_call(
+            message, response, cache_key, return_json, return_message
+        )
+
+    @tenacity
+    async def call_async(
+        self,
+        content: str,
+        images: list[str] = None,
+        system_message: str = None,
+        history: list = None,
+        return_json: bool = False,
+        return_message: bool = False,
+    ) -> str | dict | list:
+        """
+        Asynchronously call the language model, allowing independent prompts to be issued concurrently.
+
+        Args:
+            content (str): The prompt content.
+            images (list[str]): A list of image file paths.
+            system_message (str): The system message.
+            history (list): The conversation history.
+            return_json (bool): Whether to return the response as JSON.
+            return_message (bool): Whether to return the message.
+
+        Returns:
+            str | dict | list: The response from the model.
+        """
+        messages, message, cache_key, response = self._prepare_call(
+            content, images, system_message, history
+        )
+        if response is None:
+            completion = await self.async_client.chat.completions.create(
+                model=self.model, messages=messages
             )
             response = completion.choices[0].message.content
+        return self._finish_call(
+            message, response, cache_key, return_json, return_message
+        )
+
+    def _prepare_call(
+        self,
+        content: str,
+        images: list[str] = None,
+        system_message: str = None,
+        history: list = None,
+    ) -> tuple[list, list, str | None, str | None]:
+        """
+        Format the messages of a call and look up its cached response.
+
+        Returns:
+            tuple: The messages to send, the user message, the cache key and the cached response.
+        """
+        if content.startswith("You are"):
+            system_message, content = content.split("\n", 1)
+        if history is None:
+            history = []
+        if isinstance(images, str):
+            images = [images]
+        system, message = self.format_message(content, images, system_message)
+        messages = system + history + message
+        cache_key, response = self._get_cached(messages)
+        return messages, message, cache_key, response
 
+    def _finish_call(
+        self,
+        message: list,
+        response: str,
+        cache_key: str | None,
+        return_json: bool,
+        return_message: bool,
+    ) -> str | dict | list:
+        """
+        Parse the response of a call and cache it once it is parsed.
+        """
         message.append({"role": "assistant", "content": response})
         if return_json:
             response = get_json_from_response(response)
+        self._set_cached(cache_key, message[-1]["content"])
         if return_message:
             response = (response, message)
         return response
 
+    def set_cache(self, use_cache: bool):
+        """
+        Enable or disable reusing responses of identical requests across runs.
+        """
+        self.cache = ResponseCache(pjoin(CACHE_DIR, "llm.db")) if use_cache else None
+
+    def _get_cached(self, messages: list) -> tuple[str | None, str | None]:
+        """
+        Look up the cached response of the messages, return the cache key and the response.
+        The key is None on a hit, so a cached response is never written back.
+        """
+        if self.cache is None:
+            return None, None
+        cache_key = ResponseCache.get_key(self.model, messages)
+        response = self.cache.get(cache_key)
+        if response is not None:
+            return None, response
+        return cache_key, None
+
+    def _set_cached(self, cache_key: str | None, response: str):
+        """
+        Cache a response, only called after a requested JSON parse succeeds, so malformed replies are not replayed.
+        """
+        if cache_key is not None:
+            self.cache.set(cache_key, response)
+
     def __repr__(self) -> str:
         return f"LLM(model={self.model}, api_base={self.api_base})"
 
@@ -194,16 +466,91 @@ class LLM:
             if not isinstance(images, list):
                 images = [images]
             for image in images:
-                with open(image, "rb") as f:
-                    message[0]["content"].append(
+                stat = os.stat(image)
+                base64_image = encode_image(image, stat.st_mtime_ns, stat.st_size)
+                message[0]["content"].append(
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                    }
+                )
+        return system, message
+
+    def submit_batch(
+        self, prompts: list[str], batch_file: str, poll_interval: int = 60
+    ) -> list[str]:
+        """
+        Submit prompts through OpenAI's Batch API and wait for their responses.
+        The batch id is saved next to the batch file with the hash of the prompts,
+        so an interrupted run resumes the submitted batch only if its prompts are unchanged.
+
+        Args:
+            prompts (list[str]): The prompts to submit.
+            batch_file (str): The path to write the batch input file.
+            poll_interval (int): The interval in seconds between status checks.
+
+        Returns:
+            list[str]: The responses in the order of prompts, None for failed requests.
+        """
+        if len(prompts) == 0:
+            return []
+        batch_id_file = batch_file + ".id"
+        prompts_hash = hashlib.sha256(
+            json.dumps([self.model, prompts]).encode()
+        ).hexdigest()
+        batch_id = None
+        if pexists(batch_id_file):
+            with open(batch_id_file) as f:
+                saved_id, saved_hash = (f.read().split() + [None, None])[:2]
+            # custom ids are prompt indexes, a batch of other prompts must not be reused
+            if saved_hash == prompts_hash:
+                batch_id = saved_id
+            else:
+                print(f"Prompts changed since batch {saved_id}, submitting a new batch")
+        if batch_id is None:
+            with jsonlines.open(batch_file, "w") as writer:
+                for idx, prompt in enumerate(prompts):
+                    system_message = None
+                    if prompt.startswith("You are"):
+                        system_message, prompt = prompt.split("\n", 1)
+                    system, message = self.format_message(prompt, None, system_message)
+                    writer.write(
                         {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode('utf-8')}"
-                            },
+                            "custom_id": str(idx),
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": {"model": self.model, "messages": system + message},
                         }
                     )
-        return system, message
+            with open(batch_file, "rb") as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch_id = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            ).id
+            with open(batch_id_file, "w") as f:
+                f.write(f"{batch_id}\n{prompts_hash}")
+
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in ["failed", "expired", "cancelled"]:
+                raise RuntimeError(f"Batch {batch_id} {batch.status}", batch.errors)
+            sleep(poll_interval)
+
+        responses = [None] * len(prompts)
+        if batch.output_file_id is None:
+            return responses
+        output = self.client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            result = json.loads(line)
+            if result["response"] is None or result["response"]["status_code"] != 200:
+                continue
+            message = result["response"]["body"]["choices"][0]["message"]
+            responses[int(result["custom_id"])] = message["content"]
+        return responses
 
     def get_batch_result(self):
         """
@@ -219,6 +566,34 @@ class LLM:
         self.history = []
 
 
+RETRY_TEMPLATE = Template(
+    """The previous output is invalid, please carefully analyze the traceback and feedback information, correct errors happened before.
+            feedback:
+            {{feedback}}
+            traceback:
+            {{traceback}}
+            Give your corrected output in the same format without including the previous output:
+            """
+)
+
+
+@lru_cache(maxsize=None)
+def load_role_config(name: str) -> dict:
+    """
+    Load the configuration of a role, read once per process.
+    """
+    with open(f"roles/{name}.yaml", "r") as f:
+        return yaml.safe_load(f)
+
+
+@lru_cache(maxsize=None)
+def compile_template(env: Environment, source: str) -> Template:
+    """
+    Compile a template in an environment, compiled once per process.
+    """
+    return env.from_string(source)
+
+
 @dataclass
 class Turn:
     """
@@ -263,6 +638,7 @@ class Role:
         llm: LLM = None,
         config: dict = None,
         text_model: BGEM3FlagModel = None,
+        semantic_cache: SemanticCache = None,
     ):
         """
         Initialize the Agent.
@@ -274,31 +650,25 @@ class Role:
             llm (LLM): The language model.
             config (dict): The configuration.
             text_model (BGEM3FlagModel): The text model.
+            semantic_cache (SemanticCache): The cache of responses to similar prompts.
         """
         self.name = name
         if config is None:
-            with open(f"roles/{name}.yaml", "r") as f:
-                config = yaml.safe_load(f)
+            config = load_role_config(name)
         if llm is None:
             llm = globals()[config["use_model"] + "_model"]
         self.llm = llm
         self.model = llm.model
         self.record_cost = record_cost
         self.text_model = text_model
+        self.semantic_cache = semantic_cache
+        self.reuse_similar = config.get("reuse_similar", False)
         self.return_json = config["return_json"]
         self.system_message = config["system_prompt"]
         self.prompt_args = set(config["jinja_args"])
-        self.template = env.from_string(config["template"])
-        self.retry_template = Template(
-            """The previous output is invalid, please carefully analyze the traceback and feedback information, correct errors happened before.
-            feedback:
-            {{feedback}}
-            traceback:
-            {{traceback}}
-            Give your corrected output in the same format without including the previous output:
-            """
-        )
-        self.system_tokens = len(ENCODING.encode(self.system_message))
+        self.template = compile_template(env, config["template"])
+        self.retry_template = RETRY_TEMPLATE
+        self.system_tokens = calc_text_tokens(self.system_message)
         self.input_tokens = 0
         self.output_tokens = 0
         self.history: list[Turn] = []
@@ -318,17 +688,47 @@ class Role:
         Get the conversation history.
         """
         history = self.history[-recent:] if recent > 0 else []
-        if similar > 0:
+        candidates = [turn for turn in self.history if turn.embedding is not None]
+        if similar > 0 and len(candidates) > 0:
             embedding = get_text_embedding(prompt, self.text_model)
-            history.sort(key=lambda x: cosine_similarity(embedding, x.embedding))
-            for turn in history:
-                if len(history) > similar + recent:
+            # at most `recent` of the top scored turns are already in history
+            scores = cosine_similarity(
+                stack([turn.embedding for turn in candidates]),
+                embedding.unsqueeze(0),
+                dim=-1,
+            )
+            top_indexs = scores.topk(min(similar + recent, len(candidates))).indices
+            # Turn is unhashable, so track the selected turns by identity
+            selected = {id(turn) for turn in history}
+            for idx in top_indexs.tolist():
+                if len(history) >= similar + recent:
                     break
-                if turn not in history:
-                    history.append(turn)
+                if id(candidates[idx]) not in selected:
+                    history.append(candidates[idx])
+                    selected.add(id(candidates[idx]))
         history.sort(key=lambda x: x.id)
         return history
 
+    def fork(self) -> "Role":
+        """
+        Fork the role with an empty history, so independent tasks can run concurrently.
+        """
+        forked = copy(self)
+        forked.history = []
+        forked.input_tokens = 0
+        forked.output_tokens = 0
+        return forked
+
+    def merge(self, forked: "Role"):
+        """
+        Merge the history and cost of a forked role back into this role.
+        """
+        for turn in forked.history:
+            turn.id = len(self.history)
+            self.history.append(turn)
+        self.input_tokens += forked.input_tokens
+        self.output_tokens += forked.output_tokens
+
     def save_history(self, output_dir: str):
         """
         Save the conversation history to a file.
@@ -358,12 +758,13 @@ class Role:
         response, message = self.llm(
             prompt,
             history=history,
+            return_json=self.return_json,
             return_message=True,
         )
         turn = Turn(
             id=len(self.history),
             prompt=prompt,
-            response=response,
+            response=message[-1]["content"],
             message=message,
         )
         return self.__post_process__(response, self.history[-error_idx:], turn)
@@ -399,27 +800,50 @@ class Role:
         for turn in history:
             history_msg.extend(turn.message)
 
-        response, message = self.llm(
-            prompt,
-            system_message=self.system_message,
-            history=history_msg,
-            images=images,
-            return_message=True,
-        )
+        # only standalone text prompts are answered from the cache, and near-identical
+        # prompts only for roles whose prompts carry no per-slide content
+        use_cache = self.semantic_cache is not None and not images and not history
+        cached = None
+        if use_cache:
+            cache_key = SemanticCache.get_key(self.name, self.system_message, prompt)
+            cached = self.semantic_cache.get(cache_key, prompt, self.reuse_similar)
+        if cached is not None:
+            _, message = self.llm.format_message(prompt)
+            message.append({"role": "assistant", "content": cached})
+            response = get_json_from_response(cached) if self.return_json else cached
+        else:
+            # parsed inside the llm call, so a malformed reply is never cached
+            response, message = self.llm(
+                prompt,
+                system_message=self.system_message,
+                history=history_msg,
+                images=images,
+                return_json=self.return_json,
+                return_message=True,
+            )
         turn = Turn(
             id=len(self.history),
             prompt=prompt,
-            response=response,
+            response=message[-1]["content"],
             message=message,
             images=images,
         )
-        return self.__post_process__(response, history, turn, similar)
+        result = self.__post_process__(response, history, turn, similar)
+        if use_cache and cached is None:
+            self.semantic_cache.set(
+                cache_key, prompt, turn.response, self.reuse_similar
+            )
+        return result
 
     def __post_process__(
-        self, response: str, history: list[Turn], turn: Turn, similar: int = 0
+        self,
+        response: str | dict | list,
+        history: list[Turn],
+        turn: Turn,
+        similar: int = 0,
     ):
         """
-        Post-process the response from the agent.
+        Post-process the parsed response from the agent, recording its turn.
         """
         self.history.append(turn)
         if similar > 0:
@@ -427,8 +851,6 @@ class Role:
         if self.record_cost:
             turn.calc_token()
             self.calc_cost(history + [turn])
-        if self.return_json:
-            response = get_json_from_response(response)
         return response
 
 
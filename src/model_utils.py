@@ -1,20 +1,24 @@
+from __future__ import annotations
+
+import hashlib
 import json
 import os
+import sqlite3
+import threading
 from copy import deepcopy
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
 import numpy as np
 import torch
-import torchvision.transforms as T
-from FlagEmbedding import BGEM3FlagModel
-from marker.config.parser import ConfigParser
-from marker.converters.pdf import PdfConverter
-from marker.output import text_from_rendered
 from PIL import Image
-from torchvision.transforms.functional import InterpolationMode
-from transformers import AutoFeatureExtractor, AutoModel
 
 from presentation import Presentation, SlidePage
-from utils import is_image_path, pjoin
+from utils import CACHE_DIR, is_image_path, pjoin
+
+# heavy model libraries are imported on first use, so importing this module stays fast
+if TYPE_CHECKING:
+    from FlagEmbedding import BGEM3FlagModel
 
 device_count = torch.cuda.device_count()
 
@@ -62,6 +66,8 @@ def get_text_model(device: str = None) -> BGEM3FlagModel:
     Returns:
         BGEM3FlagModel: The initialized text model.
     """
+    from FlagEmbedding import BGEM3FlagModel
+
     return BGEM3FlagModel(
         "BAAI/bge-m3",
         use_fp16=True,
@@ -79,6 +85,8 @@ def get_image_model(device: str = None):
     Returns:
         tuple: A tuple containing the feature extractor and the image model.
     """
+    from transformers import AutoFeatureExtractor, AutoModel
+
     model_base = "google/vit-base-patch16-224-in21k"
     return (
         AutoFeatureExtractor.from_pretrained(
@@ -110,6 +118,10 @@ def parse_pdf(
     Returns:
         str: The full text extracted from the PDF.
     """
+    from marker.config.parser import ConfigParser
+    from marker.converters.pdf import PdfConverter
+    from marker.output import text_from_rendered
+
     os.makedirs(output_path, exist_ok=True)
     config_parser = ConfigParser(
         {
@@ -135,11 +147,71 @@ def parse_pdf(
     return full_text
 
 
+class EmbeddingCache:
+    """
+    A persistent cache of text embeddings, keyed by the hash of the model name and text.
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Initialize the EmbeddingCache.
+
+        Args:
+            db_path (str): The path to the sqlite database.
+        """
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)"
+        )
+
+    @staticmethod
+    def get_key(model_name: str, text: str) -> bytes:
+        return hashlib.blake2b(
+            f"{model_name}\n{text}".encode(), digest_size=16
+        ).digest()
+
+    def get_many(self, keys: list[bytes], chunksize: int = 500) -> dict:
+        """
+        Look up the cached embeddings of keys, missing keys are left out of the result.
+        """
+        embeddings = {}
+        with self.lock:
+            for i in range(0, len(keys), chunksize):
+                chunk = keys[i : i + chunksize]
+                rows = self.conn.execute(
+                    "SELECT key, vec FROM embeddings WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                for key, vec in rows:
+                    embeddings[key] = np.frombuffer(vec, dtype=np.float32)
+        return embeddings
+
+    def set_many(self, embeddings: dict):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                [
+                    (key, np.asarray(vec, dtype=np.float32).tobytes())
+                    for key, vec in embeddings.items()
+                ],
+            )
+            self.conn.commit()
+
+
+@lru_cache(maxsize=1)
+def get_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache(pjoin(CACHE_DIR, "embeddings.db"))
+
+
 def get_text_embedding(
     text: list[str], model: BGEM3FlagModel, batchsize: int = 32
 ) -> list[torch.Tensor]:
     """
     Generate text embeddings for a list of text strings.
+    Embeddings are cached on disk, so only texts never seen by the model are encoded.
 
     Args:
         text (list[str]): A list of text strings.
@@ -149,16 +221,28 @@ def get_text_embedding(
     Returns:
         list: A list of text embeddings.
     """
+    texts = [text] if isinstance(text, str) else text
+    if len(texts) == 0:
+        return []
+    model_name = getattr(model, "model_name_or_path", "BAAI/bge-m3")
+    cache = get_embedding_cache()
+    keys = [EmbeddingCache.get_key(model_name, t) for t in texts]
+    embeddings = cache.get_many(keys)
+    missing = {k: t for k, t in zip(keys, texts) if k not in embeddings}
+    if len(missing) != 0:
+        # encode sorts texts by length, so each batch pads only to similar lengths
+        dense_vecs = model.encode(list(missing.values()), batch_size=batchsize)[
+            "dense_vecs"
+        ]
+        new_embeddings = dict(zip(missing.keys(), dense_vecs))
+        cache.set_many(new_embeddings)
+        embeddings.update(new_embeddings)
+    result = torch.tensor(
+        np.stack([embeddings[k] for k in keys]), dtype=torch.float32
+    ).to(model.device)
     if isinstance(text, str):
-        return torch.tensor(model.encode(text)["dense_vecs"]).to(model.device)
-    result = []
-    for i in range(0, len(text), batchsize):
-        result.extend(
-            torch.tensor(model.encode(text[i : i + batchsize])["dense_vecs"]).to(
-                model.device
-            )
-        )
-    return result
+        return result[0]
+    return list(result)
 
 
 def get_image_embedding(
@@ -176,6 +260,8 @@ def get_image_embedding(
     Returns:
         dict: A dictionary mapping image filenames to their embeddings.
     """
+    import torchvision.transforms as T
+
     transform = T.Compose(
         [
             T.Resize(int((256 / 224) * extractor.size["height"])),
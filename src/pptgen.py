@@ -1,23 +1,44 @@
+from __future__ import annotations
+
 import json
 import os
+import pickle
+import threading
 import traceback
 from abc import ABC, abstractmethod
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
 from dataclasses import dataclass, field
 from datetime import datetime
+from typing import TYPE_CHECKING
 
 import jsonlines
-import PIL.Image
 import torch
-from FlagEmbedding import BGEM3FlagModel
 from jinja2 import Environment, StrictUndefined
+from rapidfuzz import fuzz
+from rapidfuzz.process import extractOne
+from rapidfuzz.utils import default_process
 from rich import print
 
 from apis import API_TYPES, CodeExecutor
-from llms import Role
+from llms import Role, SemanticCache
 from model_utils import get_text_embedding
 from presentation import Presentation, SlidePage
-from utils import Config, get_slide_content, pexists, pjoin, tenacity
+from utils import (
+    Config,
+    fast_clone,
+    get_image_size,
+    get_slide_content,
+    pexists,
+    pjoin,
+    tenacity,
+)
+
+if TYPE_CHECKING:
+    from FlagEmbedding import BGEM3FlagModel
+
+# shared by all generators, so role templates are compiled once per process
+JINJA_ENV = Environment(undefined=StrictUndefined)
 
 
 @dataclass
@@ -37,6 +58,8 @@ class PPTGen(ABC):
         force_pages: bool = False,
         error_exit: bool = True,
         record_cost: bool = True,
+        max_workers: int = 8,
+        semantic_cache: bool = False,
         **kwargs,
     ):
         """
@@ -48,12 +71,17 @@ class PPTGen(ABC):
             force_pages (bool): Whether to force a specific number of pages.
             error_exit (bool): Whether to exit on error.
             record_cost (bool): Whether to record the cost of generation.
+            max_workers (int): The number of slides to generate concurrently.
+            semantic_cache (bool): Whether to reuse responses of repeated or, for roles with reuse_similar, near-identical prompts.
             **kwargs: Additional arguments.
         """
         self.text_model = text_model
         self.retry_times = retry_times
         self.force_pages = force_pages
         self.error_exit = error_exit
+        self.max_workers = max_workers
+        self.build_lock = threading.Lock()
+        self.semantic_cache = semantic_cache
         self._hire_staffs(record_cost, **kwargs)
 
     def set_reference(
@@ -75,10 +103,12 @@ class PPTGen(ABC):
         self.slide_induction = slide_induction
         self.functional_keys = slide_induction.pop("functional_keys")
         self.layout_names = list(slide_induction.keys())
-        self.layout_embeddings = torch.stack(
-            get_text_embedding(self.layout_names, self.text_model)
+        # normalized once, so layout similarity is a plain matmul
+        self.layout_embeddings = torch.nn.functional.normalize(
+            torch.stack(get_text_embedding(self.layout_names, self.text_model)), dim=-1
         )
         self.empty_prs = deepcopy(presentation)
+        self.slide_blobs: dict[int, bytes] = {}
         return self
 
     def generate_pres(
@@ -105,6 +135,8 @@ class PPTGen(ABC):
         """
         self.config = config
         self.doc_json = doc_json
+        if self.semantic_cache:
+            self._load_llm_cache()
         meta_data = "\n".join(
             [f"{k}: {v}" for k, v in self.doc_json.get("metadata", {}).items()]
         )
@@ -112,9 +144,11 @@ class PPTGen(ABC):
             f"{meta_data}\nPresentation Time: {datetime.now().strftime('%Y-%m-%d')}\n"
         )
         self.image_information = ""
-        for k, v in images.items():
+        for k in images:
             assert pexists(k), f"Image {k} not found"
-            size = PIL.Image.open(k).size
+        with ThreadPoolExecutor(min(32, len(images) or 1)) as executor:
+            sizes = executor.map(get_image_size, images)
+        for (k, v), size in zip(images.items(), sizes):
             self.image_information += (
                 f"Image path: {k}, size: {size[0]}*{size[1]} px\n caption: {v}\n"
             )
@@ -127,40 +161,111 @@ class PPTGen(ABC):
                 for slide_idx, slide_title in enumerate(self.outline)
             ]
         )
+        slides_data = list(enumerate(self.outline.items()))
+        if self.force_pages:
+            slides_data = slides_data[:num_slides]
+        # each slide is generated by a fork with its own agent histories and executor
+        forks = [(self._fork(), CodeExecutor(self.retry_times)) for _ in slides_data]
         generated_slides = []
-        for slide_data in enumerate(self.outline.items()):
-            if self.force_pages and slide_data[0] == num_slides:
-                break
-            slide = self._generate_slide(slide_data, code_executor)
-            if slide is not None:
-                generated_slides.append(slide)
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [
+                executor.submit(fork._generate_slide, slide_data, fork_executor)
+                for (fork, fork_executor), slide_data in zip(forks, slides_data)
+            ]
+            for future in futures:
+                slide = future.result()
+                if slide is not None:
+                    generated_slides.append(slide)
+                    continue
+                if self.error_exit:
+                    succ_flag = False
+                    for pending in futures:
+                        pending.cancel()
+                    break
+        for (fork, fork_executor), future in zip(forks, futures):
+            if future.cancelled():
                 continue
-            if self.error_exit:
-                succ_flag = False
-                break
+            for name, role in fork.staffs.items():
+                self.staffs[name].merge(role)
+            code_executor.api_history.extend(fork_executor.api_history)
+            code_executor.command_history.extend(fork_executor.command_history)
+            code_executor.code_history.extend(fork_executor.code_history)
         self._save_history(code_executor)
         if succ_flag:
             self.empty_prs.slides = generated_slides
             self.empty_prs.save(pjoin(self.config.RUN_DIR, "final.pptx"))
 
+    def _clone_slide(self, template_id: int) -> SlidePage:
+        """
+        Clone a slide of the reference presentation, which is pickled once per template.
+        """
+        if template_id not in self.slide_blobs:
+            self.slide_blobs[template_id] = pickle.dumps(
+                self.presentation.slides[template_id - 1],
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        return pickle.loads(self.slide_blobs[template_id])
+
+    def _fork(self) -> "PPTGen":
+        """
+        Fork the generator with forked staffs, sharing the reference presentation.
+        """
+        forked = copy(self)
+        forked.staffs = {name: role.fork() for name, role in self.staffs.items()}
+        return forked
+
+    def _load_llm_cache(self):
+        """
+        Attach a semantic cache to each staff, restored from the previous run if any.
+        """
+        cache_dir = pjoin(self.config.RUN_DIR, "llm_cache")
+        for name, role in self.staffs.items():
+            role.semantic_cache = SemanticCache(self.text_model)
+            if pexists(pjoin(cache_dir, f"{name}.pkl")):
+                role.semantic_cache.load(pjoin(cache_dir, f"{name}.pkl"))
+
     def _save_history(self, code_executor: CodeExecutor):
         """
         Save the history of code execution, API calls and agent steps.
         """
-        os.makedirs(pjoin(self.config.RUN_DIR, "history"), exist_ok=True)
+        history_dir = pjoin(self.config.RUN_DIR, "history")
+        cache_dir = pjoin(self.config.RUN_DIR, "llm_cache")
+        os.makedirs(history_dir, exist_ok=True)
+        if self.semantic_cache:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        def write_jsonl(filename: str, rows: list):
+            with jsonlines.open(pjoin(self.config.RUN_DIR, filename), "w") as writer:
+                writer.write_all(rows)
+
+        # every file is independent, so they are written concurrently
+        with ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(role.save_history, history_dir)
+                for role in self.staffs.values()
+            ]
+            if self.semantic_cache:
+                futures.extend(
+                    executor.submit(
+                        role.semantic_cache.save, pjoin(cache_dir, f"{name}.pkl")
+                    )
+                    for name, role in self.staffs.items()
+                )
+            if len(code_executor.code_history) != 0:
+                futures.append(
+                    executor.submit(
+                        write_jsonl, "code_steps.jsonl", code_executor.code_history
+                    )
+                )
+                futures.append(
+                    executor.submit(
+                        write_jsonl, "agent_steps.jsonl", code_executor.api_history
+                    )
+                )
+            for future in futures:
+                future.result()
         for role in self.staffs.values():
-            role.save_history(pjoin(self.config.RUN_DIR, "history"))
             role.history = []
-        if len(code_executor.code_history) == 0:
-            return
-        with jsonlines.open(
-            pjoin(self.config.RUN_DIR, "code_steps.jsonl"), "w"
-        ) as writer:
-            writer.write_all(code_executor.code_history)
-        with jsonlines.open(
-            pjoin(self.config.RUN_DIR, "agent_steps.jsonl"), "w"
-        ) as writer:
-            writer.write_all(code_executor.api_history)
 
     @tenacity
     def _generate_outline(self, num_slides: int):
@@ -174,7 +279,7 @@ class PPTGen(ABC):
             dict: The generated outline.
         """
         outline_file = pjoin(self.config.RUN_DIR, "presentation_outline.json")
-        doc_overview = deepcopy(self.doc_json)
+        doc_overview = fast_clone(self.doc_json)
         for section in doc_overview["sections"]:
             [sub.pop("content") for sub in section["subsections"]]
         if pexists(outline_file):
@@ -198,51 +303,83 @@ class PPTGen(ABC):
             )
         return outline
 
-    def _valid_outline(self, outline: dict, retry: int = 0) -> dict:
+    def _valid_outline(self, outline: dict) -> dict:
         """
-        Validate the generated outline.
+        Validate the generated outline, the planner is asked to fix an invalid one.
+
+        Raises:
+            ValueError: If the outline is still invalid after retries.
+        """
+        for retry in range(self.retry_times + 1):
+            try:
+                return self._check_outline(outline)
+            except ValueError as e:
+                print(outline, e)
+                if retry == self.retry_times:
+                    break
+                # formatting the traceback walks every frame, only do it when debugging
+                tb = traceback.format_exc() if self.config.DEBUG else ""
+                outline = self.staffs["planner"].retry(str(e), tb, retry + 1)
+        raise ValueError("Failed to generate outline, tried too many times")
+
+    def _check_outline(self, outline: dict) -> dict:
+        """
+        Check the structure of an outline and map its layouts to the layout names.
 
         Raises:
             ValueError: If the outline is invalid.
         """
-        try:
-            for slide in outline.values():
-                layout_sim = torch.cosine_similarity(
-                    get_text_embedding(slide["layout"], self.text_model),
-                    self.layout_embeddings,
-                )
-                if layout_sim.max() < 0.7:
+        # layouts copied nearly verbatim are matched lexically, only the rest are embedded
+        slides = []
+        for slide in outline.values():
+            match = extractOne(
+                slide["layout"],
+                self.layout_names,
+                scorer=fuzz.ratio,
+                processor=default_process,
+                score_cutoff=90,
+            )
+            if match is None:
+                slides.append(slide)
+            else:
+                slide["layout"] = match[0]
+        if len(slides) != 0:
+            layout_embeddings = torch.nn.functional.normalize(
+                torch.stack(
+                    get_text_embedding(
+                        [slide["layout"] for slide in slides], self.text_model
+                    )
+                ),
+                dim=-1,
+            )
+            layout_sims, layout_idxs = (
+                layout_embeddings @ self.layout_embeddings.T
+            ).max(dim=1)
+            for slide, layout_sim, layout_idx in zip(
+                slides, layout_sims.tolist(), layout_idxs.tolist()
+            ):
+                if layout_sim < 0.7:
                     raise ValueError(
                         f"Layout `{slide['layout']}` not found, must be one of {self.layout_names}"
                     )
-                slide["layout"] = self.layout_names[layout_sim.argmax().item()]
-            if any(
-                not {"layout", "subsections", "description"}.issubset(set(slide.keys()))
-                for slide in outline.values()
-            ):
-                raise ValueError(
-                    "Invalid outline structure, must be a dict with layout, subsections, description"
-                )
-        except ValueError as e:
-            print(outline, e)
-            if retry < self.retry_times:
-                new_outline = self.staffs["planner"].retry(
-                    str(e), traceback.format_exc(), retry + 1
-                )
-                return self._valid_outline(new_outline, retry + 1)
-            else:
-                raise ValueError("Failed to generate outline, tried too many times")
+                slide["layout"] = self.layout_names[layout_idx]
+        if any(
+            not {"layout", "subsections", "description"}.issubset(set(slide.keys()))
+            for slide in outline.values()
+        ):
+            raise ValueError(
+                "Invalid outline structure, must be a dict with layout, subsections, description"
+            )
         return outline
 
     def _hire_staffs(self, record_cost: bool, **kwargs) -> dict[str, Role]:
         """
         Initialize agent roles and their models
         """
-        jinja_env = Environment(undefined=StrictUndefined)
         self.staffs = {
             role: Role(
                 role,
-                env=jinja_env,
+                env=JINJA_ENV,
                 record_cost=record_cost,
                 text_model=self.text_model,
                 **kwargs,
@@ -282,7 +419,7 @@ class PPTGen(ABC):
         slide_content = f"Slide-{slide_idx+1} " + get_slide_content(
             self.doc_json, slide_title, slide
         )
-        template = deepcopy(self.slide_induction[slide["layout"]])
+        template = fast_clone(self.slide_induction[slide["layout"]])
         try:
             return self.synergize(
                 template,
@@ -340,9 +477,7 @@ class PPTCrew(PPTGen):
             command_list="\n".join([str(i) for i in command_list]),
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide = self._clone_slide(template["template_id"])
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 break
@@ -351,7 +486,8 @@ class PPTCrew(PPTGen):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["coder"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        with self.build_lock:
+            self.empty_prs.build_slide(edited_slide)
         return edited_slide
 
     def _prepare_schema(self, content_schema: dict):
@@ -366,22 +502,19 @@ class PPTCrew(PPTGen):
         """
         old_data = {}
         for el_name, el_info in content_schema.items():
+            data = el_info.pop("data")
             if el_info["type"] == "text":
-                if not isinstance(el_info["data"], list):
-                    el_info["data"] = [el_info["data"]]
-                if len(el_info["data"]) > 1:
-                    charater_counts = [len(i) for i in el_info["data"]]
-                    content_schema[el_name]["suggestedCharacters"] = (
-                        str(min(charater_counts)) + "-" + str(max(charater_counts))
+                if not isinstance(data, list):
+                    data = [data]
+                if len(data) > 1:
+                    charater_counts = [len(i) for i in data]
+                    el_info["suggestedCharacters"] = (
+                        f"{min(charater_counts)}-{max(charater_counts)}"
                     )
                 else:
-                    content_schema[el_name]["suggestedCharacters"] = "<" + str(
-                        len(el_info["data"][0])
-                    )
-            old_data[el_name] = el_info.pop("data")
-            content_schema[el_name]["default_quantity"] = 1
-            if isinstance(old_data[el_name], list):
-                content_schema[el_name]["default_quantity"] = len(old_data[el_name])
+                    el_info["suggestedCharacters"] = f"<{len(data[0])}"
+            old_data[el_name] = data
+            el_info["default_quantity"] = len(data) if isinstance(data, list) else 1
         assert len(old_data) > 0, "No old data generated"
         return old_data
 
@@ -443,10 +576,9 @@ class PPTCrew(PPTGen):
             if not isinstance(new_content, list):
                 new_content = [new_content]
 
-            new_content = [i for i in new_content if i]
-
-            if content_schema[el_name]["type"] == "image":
-                new_content = [i for i in new_content if pexists(i)]
+            # empty items are dropped before any image path is checked on disk
+            is_image = content_schema[el_name]["type"] == "image"
+            new_content = [i for i in new_content if i and (not is_image or pexists(i))]
 
             quantity_change = len(new_content) - len(old_content)
             command_list.append(
@@ -1,21 +1,28 @@
 import os
+import pickle
+import re
 import shutil
 import subprocess
 import tempfile
 import traceback
+from copy import deepcopy
+from math import ceil
 from time import sleep, time
 from types import SimpleNamespace
 
 import json_repair
-import Levenshtein
+import numpy as np
 from lxml import etree
-from pdf2image import convert_from_path
+from pdf2image import pdfinfo_from_path
+from PIL import Image
 from pptx.dml.color import RGBColor
-from pptx.oxml import parse_xml
+from pptx.oxml.ns import qn
 from pptx.shapes.base import BaseShape
 from pptx.shapes.group import GroupShape
 from pptx.text.text import _Paragraph, _Run
 from pptx.util import Length, Pt
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
 from rich import print
 from tenacity import RetryCallState, retry, stop_after_attempt, wait_fixed
 
@@ -36,6 +43,12 @@ def is_image_path(file: str):
     return False
 
 
+def get_image_size(image: str) -> tuple[int, int]:
+    # only the header is parsed, the pixel data is never decoded
+    with Image.open(image) as img:
+        return img.size
+
+
 def get_font_pptcstyle(font: dict):
     font = SimpleNamespace(**font)
     return f"Font Style: bold={font.bold}, italic={font.italic}, underline={font.underline}, size={font.size}pt, color={font.color}, font style={font.name}\n"
@@ -58,10 +71,13 @@ def get_font_style(font: dict):
 def runs_merge(paragraph: _Paragraph):
     runs = paragraph.runs
     if len(runs) == 0:
-        runs = [
-            _Run(r, paragraph)
-            for r in parse_xml(paragraph._element.xml.replace("fld", "r")).r_lst
-        ]
+        # read text fields as runs of a copy, without serializing and reparsing it
+        element = deepcopy(paragraph._element)
+        for fld in element.findall(qn("a:fld")):
+            fld.tag = qn("a:r")
+            # release the proxy, so the renamed element is wrapped as a run
+            del fld
+        runs = [_Run(r, paragraph) for r in element.r_lst]
     if len(runs) == 1:
         return runs[0]
     if len(runs) == 0:
@@ -69,9 +85,10 @@ def runs_merge(paragraph: _Paragraph):
     run = max(runs, key=lambda x: len(x.text))
     run.text = paragraph.text
 
+    parent = run._r.getparent()
     for r in runs:
         if r != run:
-            r._r.getparent().remove(r._r)
+            parent.remove(r._r)
     return run
 
 
@@ -89,27 +106,37 @@ def older_than(filepath, seconds: int = 10, wait: bool = False):
     return seconds < (current_time - file_creation_time)
 
 
-def edit_distance(text1: str, text2: str):
-    return 1 - Levenshtein.distance(text1, text2) / max(len(text1), len(text2))
-
-
 def get_slide_content(doc_json: dict, slide_title: str, slide: dict):
     slide_desc = slide.get("description", "")
     slide_content = f"Slide Purpose: {slide_title}\nSlide Description: {slide_desc}\n"
-    for key in slide.get("subsections", []):
+    subsections = []
+    for section in doc_json["sections"]:
+        section_subsections = section.get("subsections", [])
+        if isinstance(section_subsections, dict) and len(section_subsections) == 1:
+            section_subsections = [
+                {"title": k, "content": v} for k, v in section_subsections.items()
+            ]
+        subsections.extend(
+            subsection
+            for subsection in section_subsections
+            if isinstance(subsection, dict)
+            and isinstance(subsection.get("title"), str)
+            and "content" in subsection
+        )
+    keys = [str(key) for key in slide.get("subsections", [])]
+    if len(keys) == 0:
+        return slide_content
+    # 1 - levenshtein / max(len) of all (key, title) pairs, the cutoff prunes early
+    similarity = cdist(
+        keys,
+        [subsection["title"] for subsection in subsections],
+        scorer=Levenshtein.normalized_similarity,
+        score_cutoff=0.9,
+    )
+    for key, key_similarity in zip(keys, similarity):
         slide_content += "Slide Content Source: "
-        for section in doc_json["sections"]:
-            subsections = section.get("subsections", [])
-            if isinstance(subsections, dict) and len(subsections) == 1:
-                subsections = [
-                    {"title": k, "content": v} for k, v in subsections.items()
-                ]
-            for subsection in subsections:
-                try:
-                    if edit_distance(key, subsection["title"]) > 0.9:
-                        slide_content += f"# {key} \n{subsection['content']}\n"
-                except:
-                    pass
+        for idx in np.nonzero(key_similarity > 0.9)[0]:
+            slide_content += f"# {key} \n{subsections[idx]['content']}\n"
     return slide_content
 
 
@@ -118,15 +145,23 @@ def tenacity_log(retry_state: RetryCallState):
     traceback.print_tb(retry_state.outcome.exception().__traceback__)
 
 
+# json strings hold no raw newlines, so a fence on its own line always closes the block
+JSON_FENCE_END = re.compile(r"^[ \t]*```[ \t]*$", re.MULTILINE)
+
+
 def get_json_from_response(raw_response: str):
     response = raw_response.strip()
-    l, r = response.rfind("```json"), response.rfind("```")
+    # the last json code block is the final answer
+    l = response.rfind("```json")
+    if l != -1:
+        response = response[l + 7 :]
+        fence_end = JSON_FENCE_END.search(response)
+        if fence_end is not None:
+            response = response[: fence_end.start()]
+        elif (r := response.rfind("```")) != -1:
+            response = response[:r]
     try:
-        if l == -1 or r == -1:
-            response = json_repair.loads(response)
-        else:
-            response = json_repair.loads(response[l + 7 : r].strip())
-        return response
+        return json_repair.loads(response.strip())
     except Exception as e:
         raise RuntimeError("Failed to parse JSON from response", e)
 
@@ -142,6 +177,10 @@ def ppt_to_images(file: str, output_dir: str, warning: bool = False):
     if pexists(output_dir) and warning:
         print(f"ppt2images: {output_dir} already exists")
     os.makedirs(output_dir, exist_ok=True)
+    # a pdf is rendered directly, without the startup cost of soffice
+    if file.endswith(".pdf"):
+        pdf_to_images(file, output_dir)
+        return
     with tempfile.TemporaryDirectory() as temp_dir:
         command_list = [
             "soffice",
@@ -157,15 +196,53 @@ def ppt_to_images(file: str, output_dir: str, warning: bool = False):
         for f in os.listdir(temp_dir):
             if not f.endswith(".pdf"):
                 continue
-            temp_pdf = pjoin(temp_dir, f)
-            images = convert_from_path(temp_pdf, dpi=72)
-            for i, img in enumerate(images):
-                img.save(pjoin(output_dir, f"slide_{i+1:04d}.jpg"))
+            pdf_to_images(pjoin(temp_dir, f), output_dir)
             return
 
         raise RuntimeError("No PDF file was created in the temporary directory", file)
 
 
+def pdf_to_images(pdf_file: str, output_dir: str):
+    # pdftoppm writes jpegs directly, page ranges are rendered by parallel processes
+    num_pages = pdfinfo_from_path(pdf_file)["Pages"]
+    if num_pages == 0:
+        return
+    num_procs = min(os.cpu_count() or 1, 8, num_pages)
+    pages_per_proc = ceil(num_pages / num_procs)
+    prefix = pjoin(output_dir, "page")
+    processes = [
+        subprocess.Popen(
+            [
+                "pdftoppm",
+                "-jpeg",
+                "-r",
+                "72",
+                "-f",
+                str(first),
+                "-l",
+                str(min(first + pages_per_proc - 1, num_pages)),
+                pdf_file,
+                prefix,
+            ]
+        )
+        for first in range(1, num_pages + 1, pages_per_proc)
+    ]
+    for process in processes:
+        if process.wait() != 0:
+            # stop the other renderers before raising, so none keeps writing pages
+            for other in processes:
+                other.kill()
+                other.wait()
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    # pdftoppm names pages like page-01.jpg, padded to the digits of the page count
+    for f in os.listdir(output_dir):
+        if f.startswith("page-") and f.endswith(".jpg"):
+            os.replace(
+                pjoin(output_dir, f),
+                pjoin(output_dir, f"slide_{int(f[5:-4]):04d}.jpg"),
+            )
+
+
 @tenacity
 def wmf_to_images(blob: bytes, filepath: str):
     if not filepath.endswith(".jpg"):
@@ -205,82 +282,111 @@ def apply_fill(shape: BaseShape, fill_xml: str):
 
 def parse_groupshape(groupshape: GroupShape):
     assert isinstance(groupshape, GroupShape)
-    group_top_left_x = groupshape.left
-    group_top_left_y = groupshape.top
-    group_width = groupshape.width
-    group_height = groupshape.height
-    shape_top_left_x = min([sp.left for sp in groupshape.shapes])
-    shape_top_left_y = min([sp.top for sp in groupshape.shapes])
-    shape_width = (
-        max([sp.left + sp.width for sp in groupshape.shapes]) - shape_top_left_x
-    )
-    shape_height = (
-        max([sp.top + sp.height for sp in groupshape.shapes]) - shape_top_left_y
-    )
-    group_shape_xy = []
-    for sp in groupshape.shapes:
-        group_shape_left = (
-            sp.left - shape_top_left_x
-        ) * group_width / shape_width + group_top_left_x
-        group_shape_top = (
-            sp.top - shape_top_left_y
-        ) * group_height / shape_height + group_top_left_y
-        group_shape_width = sp.width * group_width / shape_width
-        group_shape_height = sp.height * group_height / shape_height
-        group_shape_xy.append(
-            {
-                "left": Length(group_shape_left),
-                "top": Length(group_shape_top),
-                "width": Length(group_shape_width),
-                "height": Length(group_shape_height),
-            }
+    shapes = list(groupshape.shapes)
+    # rows of (left, top, width, height) for every child shape
+    bounds = np.fromiter(
+        (v for sp in shapes for v in (sp.left, sp.top, sp.width, sp.height)),
+        dtype=np.int64,
+        count=len(shapes) * 4,
+    ).reshape(-1, 4)
+    shape_top_left = bounds[:, :2].min(axis=0)
+    shape_size = (bounds[:, :2] + bounds[:, 2:]).max(axis=0) - shape_top_left
+    group_top_left = np.array([groupshape.left, groupshape.top])
+    group_size = np.array([groupshape.width, groupshape.height])
+    group_shape_lt = (
+        bounds[:, :2] - shape_top_left
+    ) * group_size / shape_size + group_top_left
+    group_shape_wh = bounds[:, 2:] * group_size / shape_size
+    return [
+        {
+            "left": Length(int(left)),
+            "top": Length(int(top)),
+            "width": Length(int(width)),
+            "height": Length(int(height)),
+        }
+        for (left, top), (width, height) in zip(
+            group_shape_lt.tolist(), group_shape_wh.tolist()
         )
-    return group_shape_xy
+    ]
+
+
+PRIMITIVE_TYPES = (int, float, complex, bool, str, bytes, bytearray, type(None))
 
 
 def is_primitive(obj):
+    if isinstance(obj, PRIMITIVE_TYPES):
+        return True
     if isinstance(obj, (list, tuple, set, frozenset)):
         return all(is_primitive(item) for item in obj)
-    return isinstance(
-        obj, (int, float, complex, bool, str, bytes, bytearray, type(None))
-    )
+    return False
+
 
+DEFAULT_EXCLUDE = frozenset(["element", "language_id", "ln", "placeholder_format"])
+SCHEMA_CACHE: dict[tuple[type, frozenset], list[str]] = {}
 
-DEFAULT_EXCLUDE = set(["element", "language_id", "ln", "placeholder_format"])
+
+def get_schema(obj, exclude: frozenset) -> list[str]:
+    """
+    Get the public non-callable attributes of an object, which are cached per class.
+    """
+    key = (type(obj), exclude)
+    if key not in SCHEMA_CACHE:
+        attrs = []
+        for attr in dir(obj):
+            if attr.startswith("_") or attr in exclude:
+                continue
+            try:
+                if callable(getattr(obj, attr)):
+                    continue
+            except:
+                pass
+            attrs.append(attr)
+        SCHEMA_CACHE[key] = attrs
+    return SCHEMA_CACHE[key]
 
 
 def object_to_dict(obj, result=None, exclude=None):
     if result is None:
         result = {}
     exclude = DEFAULT_EXCLUDE.union(exclude or set())
-    for attr in dir(obj):
-        if attr in exclude:
-            continue
+    for attr in get_schema(obj, exclude):
         try:
-            if not attr.startswith("_") and not callable(getattr(obj, attr)):
-                attr_value = getattr(obj, attr)
-                if "real" in dir(attr_value):
-                    attr_value = attr_value.real
-                if attr == "size" and isinstance(attr_value, int):
-                    attr_value = Length(attr_value).pt
-
-                if is_primitive(attr_value):
-                    result[attr] = attr_value
+            attr_value = getattr(obj, attr)
+            if hasattr(attr_value, "real"):
+                attr_value = attr_value.real
+            if attr == "size" and isinstance(attr_value, int):
+                attr_value = Length(attr_value).pt
+
+            if is_primitive(attr_value):
+                result[attr] = attr_value
         except:
             pass
     return result
 
 
+def fast_clone(obj):
+    """
+    Clone an object through pickle, which is much faster than deepcopy on nested objects.
+    Objects holding lxml elements, like python-pptx presentations, still require deepcopy.
+    """
+    return pickle.loads(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
 def merge_dict(d1: dict, d2: list[dict]):
     if len(d2) == 0:
         return d1
-    for key in list(d1.keys()):
-        values = [d[key] for d in d2]
-        if d1[key] is not None and len(values) != 1:
+    # only values are reassigned, so d1 can be iterated directly
+    for key in d1:
+        first = d2[0][key]
+        if first is None:
+            continue
+        values = [d[key] for d in d2[1:]]
+        if d1[key] is not None and len(d2) != 1:
             values.append(d1[key])
-        if values[0] is None or not all(value == values[0] for value in values):
+        # shared font values are often the same object, skip comparing them
+        if not all(value is first or value == first for value in values):
             continue
-        d1[key] = values[0]
+        d1[key] = first
         for d in d2:
             d[key] = None
     return d1
@@ -327,6 +433,8 @@ pjoin = os.path.join
 pexists = os.path.exists
 pbasename = os.path.basename
 
+CACHE_DIR = os.path.expanduser("~/.cache/pptagent")
+
 if __name__ == "__main__":
     config = Config()
     print(config)
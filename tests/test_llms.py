@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+import llms  # noqa: E402
+from llms import SemanticCache  # noqa: E402
+
+
+class FakeTextModel:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+@pytest.fixture
+def fake_embedding(monkeypatch):
+    def get_text_embedding(text: str, model: FakeTextModel):
+        generator = torch.Generator().manual_seed(len(text))
+        return torch.rand(8, generator=generator).to(model.device)
+
+    monkeypatch.setattr(llms, "get_text_embedding", get_text_embedding)
+
+
+def test_semantic_cache_set_after_load(tmp_path, fake_embedding):
+    cache_file = str(tmp_path / "planner.pkl")
+    first_key = SemanticCache.get_key("planner", "system", "first prompt")
+    second_key = SemanticCache.get_key("planner", "system", "second, longer prompt")
+    cache = SemanticCache(FakeTextModel())
+    cache.set(first_key, "first prompt", "first response", similar=True)
+    cache.save(cache_file)
+
+    loaded = SemanticCache(FakeTextModel())
+    loaded.load(cache_file)
+    assert loaded.keys.device == FakeTextModel.device
+    loaded.set(second_key, "second, longer prompt", "second response", similar=True)
+    assert loaded.keys.shape == (2, 8)
+    assert loaded.get(first_key, "first prompt") == "first response"
+    assert loaded.get(second_key, "second, longer prompt") == "second response"
+
+
+def test_semantic_cache_exact_only(fake_embedding):
+    cache = SemanticCache(FakeTextModel(), threshold=0.0)
+    cache.set(SemanticCache.get_key("editor", "system", "slide 1"), "slide 1", "edit 1")
+    assert cache.keys is None
+    key = SemanticCache.get_key("editor", "system", "slide 2")
+    assert cache.get(key, "slide 2") is None
+    other_role = SemanticCache.get_key("coder", "system", "slide 1")
+    assert cache.get(other_role, "slide 1") is None
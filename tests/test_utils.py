@@ -0,0 +1,20 @@
+from utils import get_json_from_response
+
+
+def test_json_fence_inside_string():
+    response = '```json\n{"code": "```python\\nprint(1)\\n```"}\n```'
+    assert get_json_from_response(response) == {"code": "```python\nprint(1)\n```"}
+
+
+def test_json_last_block_wins():
+    response = '```json\n{"a": 1}\n```\nmore\n```json\n{"b": 2}\n```'
+    assert get_json_from_response(response) == {"b": 2}
+
+
+def test_json_inline_closing_fence():
+    response = '```json\n{"a":1}```\nmore\n```json\n{"b":2}\n```'
+    assert get_json_from_response(response) == {"b": 2}
+
+
+def test_json_without_fence():
+    assert get_json_from_response('{"c": 3}') == {"c": 3}